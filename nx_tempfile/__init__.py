@@ -1,13 +1,419 @@
 """A drop-in replacement for tempfile that adds the errors argument to
 NamedTemporary and TemporaryFile.
+
+Optionally, the files may be spread across several temporary directories and
+limited by a per-process byte quota (see set_placement) and the live files may
+be tracked to find leaks (see track_files).
 """
 import os
 import io
+import time
+import types
+import errno
+import random
+import shutil
+import weakref
+import warnings
 import tempfile
+import threading
+import traceback
+import collections
 from tempfile import * # pylint: disable=wildcard-import, ungrouped-imports
 
 
-__all__ = tempfile.__all__
+__all__ = tempfile.__all__ + ['set_placement', 'ROUND_ROBIN', 'MOST_FREE',
+                             'BEST_FIT', 'track_files', 'live_files',
+                             'LiveFile']
+
+
+# Placement policies for selecting a directory from those configured
+ROUND_ROBIN = 'round-robin'
+MOST_FREE = 'most-free'
+BEST_FIT = 'best-fit'
+_POLICIES = (ROUND_ROBIN, MOST_FREE, BEST_FIT)
+
+# Not every platform defines a quota error
+_EDQUOT = getattr(errno, 'EDQUOT', errno.ENOSPC)
+
+# The active placement, None when the tempfile defaults are in effect
+_placement = None
+
+# The active file registry, None when tracking is disabled
+_registry = None
+
+LiveFile = collections.namedtuple( # pylint: disable=invalid-name
+    'LiveFile', 'name mode closed delete created traceback')
+
+
+def _disk_free(path):
+    "Return the number of bytes available to unprivileged users at <path>"
+    return shutil.disk_usage(path).free
+
+
+class _Usage:
+    "Accounting of the files counted against the quota"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Maps a weak reference to each live file to its size hint and the
+        # size it is currently charged
+        self.files = {}
+        # The charges of the live files plus the hints of those being created
+        self.total = 0
+        # The references of the collected files; the weak reference callback
+        # may run while the lock is held so it only appends to the list
+        self.dead = []
+        # When the sizes of the live files were last read
+        self.stamp = None
+
+    def prune(self):
+        "Release the charges of the collected files, with the lock held"
+        while self.dead:
+            entry = self.files.pop(self.dead.pop(), None)
+            if entry is not None:
+                self.total -= entry[1]
+
+    def refresh(self):
+        "Re-read the sizes of the live files, dropping the closed ones"
+        # The files are examined without holding the lock
+        with self.lock:
+            items = list(self.files.items())
+        sizes = []
+        for ref, (hint, _) in items:
+            fobj = ref()
+            try:
+                # A file is charged its size hint until it grows beyond it
+                size = max(os.fstat(fobj.fileno()).st_size, hint)
+            except (AttributeError, OSError, ValueError):
+                # Closed files no longer count against the quota
+                size = None
+            sizes.append((ref, size))
+
+        with self.lock:
+            for ref, size in sizes:
+                entry = self.files.get(ref)
+                if entry is None:
+                    continue
+                if size is None:
+                    del self.files[ref]
+                    self.total -= entry[1]
+                else:
+                    self.files[ref] = (entry[0], size)
+                    self.total += size - entry[1]
+            self.stamp = time.monotonic()
+
+    def reserve(self, size, quota, ttl):
+        "Reserve <size> bytes for a new file or raise if <quota> is exceeded"
+        # The sizes are only re-read when they are older than <ttl> or when
+        # the running total would reject the file
+        with self.lock:
+            self.prune()
+            if (self.stamp is not None and
+                    time.monotonic() - self.stamp < ttl and
+                    self.total + size <= quota):
+                self.total += size
+                return
+
+        self.refresh()
+        with self.lock:
+            self.prune()
+            if self.total + size > quota:
+                raise OSError(_EDQUOT, 'temporary file quota exceeded: {} of '
+                              '{} bytes in use'.format(self.total, quota))
+            self.total += size
+
+    def commit(self, fobj, size):
+        "Convert the reservation of <size> bytes into the live file <fobj>"
+        with self.lock:
+            if fobj is None:
+                self.total -= size
+            else:
+                self.files[weakref.ref(fobj, self.dead.append)] = (size, size)
+
+
+# The files counted against the quota, shared by successive placements
+_usage = _Usage()
+
+
+class _Placement:
+    "Directory selection and quota accounting for the file factories"
+
+    def __init__(self, dirs, policy, quota, ttl):
+        if policy not in _POLICIES:
+            raise ValueError('unknown placement policy: {!r}'.format(policy))
+        if quota is not None and quota < 0:
+            raise ValueError('quota must be non-negative')
+        self.dirs = [os.path.abspath(path) for path in dirs or ()]
+        self.policy = policy
+        self.quota = quota
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.index = 0
+        # Maps each directory to a (timestamp, free bytes) pair so that the
+        # file system is not queried on every allocation
+        self.cache = {}
+
+    def free(self, path):
+        "Return the (possibly cached) free bytes for <path>"
+        now = time.monotonic()
+        entry = self.cache.get(path)
+        if entry is None or now - entry[0] >= self.ttl:
+            try:
+                free = _disk_free(path)
+            except OSError:
+                # A missing or unmounted directory is never selected
+                free = 0
+            entry = self.cache[path] = (now, free)
+        return entry[1]
+
+    def fits(self, path, need):
+        "Return whether <path> is usable and has room for <need> bytes"
+        free = self.free(path)
+        return free > 0 and free >= need
+
+    def choose(self, size):
+        "Select a directory with room for <size> bytes"
+        need = size or 0
+        if self.policy == ROUND_ROBIN:
+            for _ in range(len(self.dirs)):
+                path = self.dirs[self.index]
+                self.index = (self.index + 1) % len(self.dirs)
+                if self.fits(path, need):
+                    break
+            else:
+                path = None
+        else:
+            fits = [(self.free(path), path) for path in self.dirs
+                    if self.fits(path, need)]
+            if not fits:
+                path = None
+            elif self.policy == MOST_FREE or not need:
+                path = max(fits)[1]
+            else:
+                # The tightest fit leaves the larger volumes for larger files
+                path = min(fits)[1]
+
+        if path is None:
+            raise OSError(errno.ENOSPC, 'no temporary directory has {} bytes '
+                          'available'.format(need))
+
+        # Charge the hint against the cached value so that a burst of
+        # allocations within the cache lifetime is spread out
+        if need:
+            stamp, free = self.cache[path]
+            self.cache[path] = (stamp, free - need)
+        return path
+
+    def create(self, ctor, mode, size, kwargs):
+        "Create the file according to the placement and quota"
+        # The size hint is held until the file is counted so that concurrent
+        # allocations cannot exceed the quota
+        size = size or 0
+        if self.quota is not None:
+            _usage.reserve(size, self.quota, self.ttl)
+
+        fobj = path = None
+        try:
+            if self.dirs and kwargs.get('dir') is None:
+                with self.lock:
+                    index = self.index
+                    path = kwargs['dir'] = self.choose(size)
+                    state = (self.index, self.cache.get(path))
+            fobj = _patch_encoding(ctor, mode, **kwargs)
+        finally:
+            if self.quota is not None:
+                _usage.commit(fobj, size)
+            if fobj is None and path is not None:
+                with self.lock:
+                    self.unchoose(path, size, index, state)
+        return fobj
+
+    def unchoose(self, path, size, index, state):
+        "Undo the selection of <path> for a file that was not created"
+        # Only what has not been changed by another allocation is restored
+        if self.index == state[0]:
+            self.index = index
+        if size and self.cache.get(path) is state[1]:
+            stamp, free = state[1]
+            self.cache[path] = (stamp, free + size)
+
+
+def set_placement(dirs=None, policy=ROUND_ROBIN, quota=None, ttl=1.0):
+    """Configure where TemporaryFile and NamedTemporaryFile create files.
+
+    <dirs> is a sequence of directories to choose from when no dir argument is
+    given and <policy> selects between them: ROUND_ROBIN cycles through them,
+    MOST_FREE picks the one with the most space available and BEST_FIT picks
+    the one with the least space that still satisfies the size argument.
+    Free space is cached for <ttl> seconds. Directories without room for the
+    size argument, or whose free space cannot be determined, are never
+    selected.
+
+    <quota> limits the combined size of the open files created by this module,
+    each counted as the larger of its current size and its size argument; it
+    is checked against a running total when a file is created. The sizes of
+    the open files are re-read when they are older than <ttl> seconds or the
+    total would reject the file. Files created while no quota was set are not
+    counted, while the files already counted remain so when the placement is
+    changed.
+
+    Calling with no arguments restores the tempfile defaults.
+    """
+    global _placement # pylint: disable=global-statement
+    if not dirs and quota is None:
+        _placement = None
+    else:
+        _placement = _Placement(dirs, policy, quota, ttl)
+
+
+def _allocate(ctor, mode, **kwargs):
+    "Apply the placement, if any, and create the file"
+    # The size hint is only meaningful to the placement
+    size = kwargs.pop('size', None)
+    placement = _placement
+    if placement is None:
+        return _patch_encoding(ctor, mode, **kwargs)
+    return placement.create(ctor, mode, size, kwargs)
+
+
+def _underlying(fobj):
+    "Return the objects wrapped by <fobj>, outermost first"
+    chain = []
+    while True:
+        if not isinstance(fobj, io.IOBase):
+            fobj = fobj.file
+        elif isinstance(fobj, io.TextIOBase):
+            fobj = fobj.buffer
+        elif isinstance(fobj, io.BufferedIOBase):
+            fobj = fobj.raw
+        else:
+            return chain
+        chain.append(fobj)
+
+
+class _Registry:
+    "Weak references to the files created by the module"
+
+    def __init__(self, sample, cleanup):
+        self.sample = sample
+        self.cleanup = cleanup
+        # A private generator leaves the sequence of the random module alone
+        self.rng = random.Random()
+        # Maps the weak reference of each file to a tuple of the name, mode,
+        # delete flag, creation time, allocation traceback and the objects it
+        # wraps. Holding the wrapped objects keeps them open, even when the
+        # file is part of a reference cycle, until the file itself is closed.
+        # The entries are only touched by single dict operations so no lock is
+        # needed, which also keeps the callbacks safe to run at any point.
+        self.entries = {}
+
+    def add(self, fobj, mode, delete):
+        "Track <fobj>, created with <mode> and <delete>"
+        stack = None
+        if self.sample and self.rng.random() < self.sample:
+            # Drop the frames of this module so the stack ends at the caller
+            stack = traceback.extract_stack()
+            while stack and stack[-1][0] == __file__:
+                stack.pop()
+            stack = traceback.format_list(stack)
+        entry = (getattr(fobj, 'name', None), mode, delete, time.time(),
+                 stack, _underlying(fobj))
+        if isinstance(fobj, io.IOBase):
+            # A file object closes itself when it is finalized, which may be
+            # after the weak reference is cleared, so the close is intercepted
+            # instead. The bound method keeps the file alive until it is
+            # closed, after which the reference cycle is broken.
+            fobj.close = types.MethodType(
+                self.closer(entry, type(fobj).close), fobj)
+            self.entries[weakref.ref(fobj, self.forget)] = entry
+        else:
+            # The NamedTemporaryFile wrapper does not close itself and the
+            # file it wraps is still held when the wrapper is collected
+            self.entries[weakref.ref(fobj, self.collected)] = entry
+
+    def closer(self, entry, close):
+        "Return a close method that reports a finalization leak of <entry>"
+        def wrapper(fobj):
+            leaked = getattr(fobj, '_finalizing', False) and not fobj.closed
+            try:
+                return close(fobj)
+            finally:
+                if fobj.closed:
+                    fobj.__dict__.pop('close', None)
+                if leaked:
+                    self.leaked(entry)
+        return wrapper
+
+    def forget(self, ref):
+        "Drop the entry of a collected file object"
+        self.entries.pop(ref, None)
+
+    def collected(self, ref):
+        "Report the NamedTemporaryFile wrapper collected while still open"
+        entry = self.entries.pop(ref, None)
+        if entry is not None and not entry[5][0].closed:
+            entry[5][0].close()
+            self.leaked(entry)
+
+    def leaked(self, entry):
+        "Warn about the file that was never closed and optionally remove it"
+        name, _, delete, _, stack, _ = entry
+        message = 'temporary file {} was never closed'.format(name)
+        if stack:
+            message += ('\nAllocated at (most recent call last):\n' +
+                        ''.join(stack))
+        warnings.warn(message, ResourceWarning)
+        if self.cleanup and not delete and isinstance(name, str):
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+
+    def live(self):
+        "Return a LiveFile for every file that has not been collected"
+        result = []
+        for ref, entry in list(self.entries.items()):
+            fobj = ref()
+            if fobj is not None:
+                name, mode, delete, created, stack, _ = entry
+                result.append(LiveFile(name, mode, fobj.closed, delete,
+                                       created, stack))
+        result.sort(key=lambda info: info.created)
+        return result
+
+
+def track_files(enabled=True, sample=0.0, cleanup=False):
+    """Enable or disable the tracking of the files created by the module.
+
+    Tracked files are held by weak references and reported by live_files().
+    The allocation traceback is recorded for the fraction <sample> of the
+    files. When a file is collected without having been closed a
+    ResourceWarning is issued and, if <cleanup> is true and the file was
+    created with delete=False, it is removed. Files that were closed are never
+    removed. A tracked file that is dropped without being closed is closed by
+    the cyclic garbage collector rather than immediately.
+
+    Files created before tracking was enabled are not tracked and disabling
+    tracking forgets the tracked files.
+    """
+    global _registry # pylint: disable=global-statement
+    _registry = _Registry(sample, cleanup) if enabled else None
+
+
+def live_files():
+    "Return a LiveFile, oldest first, for each tracked file still referenced"
+    registry = _registry
+    if registry is None:
+        return []
+    return registry.live()
+
+
+def _track(fobj, mode, delete):
+    "Register <fobj> if tracking is enabled and return it"
+    registry = _registry
+    if registry is not None:
+        registry.add(fobj, mode, delete)
+    return fobj
 
 
 def _patch_encoding(ctor, mode, **kwargs):
@@ -21,8 +427,9 @@ def _patch_encoding(ctor, mode, **kwargs):
     # 'strict' was specifed, the default errors mode, then the default
     # implementation can be used
     errors = kwargs.pop('errors', None)
+    delete = kwargs.get('delete', True)
     if errors is None or not binary and errors == 'strict':
-        return ctor(mode=mode, **kwargs)
+        return _track(ctor(mode=mode, **kwargs), mode, delete)
 
     # Encoding/errors are only valid for text mode
     if binary:
@@ -52,23 +459,25 @@ def _patch_encoding(ctor, mode, **kwargs):
                 encoding=None, newline=None, **kwargs)
 
     try:
-        return io.TextIOWrapper(fobj, encoding=encoding, errors=errors,
-                                newline=newline, line_buffering=line_buffering)
+        return _track(io.TextIOWrapper(fobj, encoding=encoding, errors=errors,
+                                       newline=newline,
+                                       line_buffering=line_buffering),
+                      mode, delete)
     except:
         fobj.close()
 
         # Attempt to clean up on exception if the object does not delete itself
-        if not getattr(fobj, 'delete', True):
+        if not delete:
             os.unlink(fobj.name)
 
         raise
 
 
 def TemporaryFile(mode='w+b', **kwargs): # pylint: disable=invalid-name, function-redefined
-    "Wrapper around TemporaryFile to add errors argument."
-    return _patch_encoding(tempfile.TemporaryFile, mode, **kwargs)
+    "Wrapper around TemporaryFile to add errors and size arguments."
+    return _allocate(tempfile.TemporaryFile, mode, **kwargs)
 
 
 def NamedTemporaryFile(mode='w+b', **kwargs): # pylint: disable=invalid-name, function-redefined
-    "Wrapper around NamedTemporaryFile to add errors argument."
-    return _patch_encoding(tempfile.NamedTemporaryFile, mode, **kwargs)
+    "Wrapper around NamedTemporaryFile to add errors and size arguments."
+    return _allocate(tempfile.NamedTemporaryFile, mode, **kwargs)
@@ -0,0 +1,204 @@
+# pylint: disable=missing-docstring, no-self-use, invalid-name, redefined-outer-name
+import os
+import time
+import errno
+import threading
+import pytest
+import nx_tempfile
+from nx_tempfile import (NamedTemporaryFile, TemporaryFile, set_placement,
+                         ROUND_ROBIN, MOST_FREE, BEST_FIT)
+
+
+@pytest.fixture
+def dirs(tmpdir, monkeypatch):
+    "Three directories with a fixed amount of free space each."
+    paths = [str(tmpdir.mkdir(name)) for name in ('a', 'b', 'c')]
+    free = dict(zip(paths, (100, 300, 200)))
+    monkeypatch.setattr(nx_tempfile, '_disk_free', free.__getitem__)
+    yield paths
+    set_placement()
+
+
+def parent(fobj):
+    return os.path.dirname(fobj.name)
+
+
+class TestPlacement:
+    def test_default(self):
+        set_placement()
+        assert nx_tempfile._placement is None # pylint: disable=protected-access
+
+    def test_invalid_policy(self, dirs):
+        with pytest.raises(ValueError):
+            set_placement(dirs, policy='xxx')
+
+    def test_round_robin(self, dirs):
+        set_placement(dirs, ROUND_ROBIN)
+        for expected in dirs + dirs:
+            with NamedTemporaryFile('w+t', errors='ignore') as fobj:
+                assert parent(fobj) == expected
+
+    def test_round_robin_size(self, dirs):
+        set_placement(dirs, ROUND_ROBIN, ttl=60)
+        with NamedTemporaryFile(size=150) as fobj:
+            assert parent(fobj) == dirs[1]
+        with NamedTemporaryFile(size=150) as fobj:
+            assert parent(fobj) == dirs[2]
+        with NamedTemporaryFile(size=150) as fobj:
+            # The cached free space has been charged with the first hint
+            assert parent(fobj) == dirs[1]
+
+    def test_most_free(self, dirs):
+        set_placement(dirs, MOST_FREE, ttl=60)
+        with NamedTemporaryFile(size=50) as fobj:
+            assert parent(fobj) == dirs[1]
+        with NamedTemporaryFile(size=200) as fobj:
+            assert parent(fobj) == dirs[1]
+        with NamedTemporaryFile() as fobj:
+            assert parent(fobj) == dirs[2]
+
+    def test_best_fit(self, dirs):
+        set_placement(dirs, BEST_FIT)
+        with NamedTemporaryFile(size=50) as fobj:
+            assert parent(fobj) == dirs[0]
+        with NamedTemporaryFile(size=150) as fobj:
+            assert parent(fobj) == dirs[2]
+        with NamedTemporaryFile(size=250) as fobj:
+            assert parent(fobj) == dirs[1]
+
+    def test_no_space(self, dirs):
+        for policy in (ROUND_ROBIN, MOST_FREE, BEST_FIT):
+            set_placement(dirs, policy)
+            with pytest.raises(OSError) as info:
+                TemporaryFile(size=1000)
+            assert info.value.errno == errno.ENOSPC
+
+    def test_missing_dir(self, tmpdir):
+        # Only the existing directory may be selected
+        paths = [str(tmpdir.join('missing')), str(tmpdir.mkdir('present'))]
+        try:
+            for policy in (ROUND_ROBIN, MOST_FREE, BEST_FIT):
+                set_placement(paths, policy)
+                for _ in range(2):
+                    with NamedTemporaryFile(size=1) as fobj:
+                        assert parent(fobj) == paths[1]
+                    with NamedTemporaryFile() as fobj:
+                        assert parent(fobj) == paths[1]
+        finally:
+            set_placement()
+
+    def test_explicit_dir(self, dirs, tmpdir):
+        set_placement(dirs)
+        with NamedTemporaryFile(dir=str(tmpdir)) as fobj:
+            assert parent(fobj) == str(tmpdir)
+
+
+class TestQuota:
+    def test_quota(self, dirs):
+        # The sizes are re-read on every allocation
+        set_placement(quota=10, ttl=0)
+        first = TemporaryFile()
+        first.write(b'12345678')
+        first.flush()
+        second = TemporaryFile('w+t', errors='ignore', size=2)
+        with pytest.raises(OSError) as info:
+            TemporaryFile(size=1)
+        assert info.value.errno == nx_tempfile._EDQUOT # pylint: disable=protected-access
+        first.close()
+        TemporaryFile(size=8).close()
+        second.close()
+
+    def test_quota_with_dirs(self, dirs):
+        set_placement(dirs, quota=0)
+        with NamedTemporaryFile() as fobj:
+            assert parent(fobj) == dirs[0]
+        with pytest.raises(OSError):
+            NamedTemporaryFile(size=1)
+
+    def test_quota_cached_sizes(self, dirs, monkeypatch):
+        clock = [1000.0]
+        monkeypatch.setattr(nx_tempfile.time, 'monotonic', lambda: clock[0])
+        monkeypatch.setattr(nx_tempfile._usage, 'stamp', None) # pylint: disable=protected-access
+        set_placement(quota=10, ttl=60)
+        with TemporaryFile() as fobj:
+            TemporaryFile().close()
+            fobj.write(b'12345678')
+            fobj.flush()
+            # The growth is not seen until the sizes are re-read but the
+            # quota is still enforced when the running total is exceeded
+            TemporaryFile(size=2).close()
+            clock[0] += 60
+            with pytest.raises(OSError):
+                TemporaryFile(size=3)
+            TemporaryFile(size=2).close()
+
+    def test_quota_rejected_keeps_dir(self, tmpdir, monkeypatch):
+        path = str(tmpdir)
+        monkeypatch.setattr(nx_tempfile, '_disk_free', lambda _: 100)
+        try:
+            set_placement([path], BEST_FIT, quota=50, ttl=60)
+            held = NamedTemporaryFile(size=30)
+            with pytest.raises(OSError) as info:
+                NamedTemporaryFile(size=40)
+            assert info.value.errno == nx_tempfile._EDQUOT # pylint: disable=protected-access
+            held.close()
+            # The rejected file was not charged against the cached free space
+            NamedTemporaryFile(size=50).close()
+        finally:
+            set_placement()
+
+    def test_failed_create_keeps_dir(self, dirs):
+        set_placement(dirs, ROUND_ROBIN, ttl=60)
+        with NamedTemporaryFile(size=100) as fobj:
+            assert parent(fobj) == dirs[0]
+        with pytest.raises(ValueError):
+            NamedTemporaryFile('wb', errors='ignore', size=150)
+        # Neither the rotation nor the cached free space has moved on
+        with NamedTemporaryFile(size=150) as fobj:
+            assert parent(fobj) == dirs[1]
+        with NamedTemporaryFile(size=150) as fobj:
+            assert parent(fobj) == dirs[2]
+
+    def test_quota_reconfigure(self, dirs):
+        set_placement(quota=100)
+        fobj = TemporaryFile(size=90)
+        set_placement(dirs, MOST_FREE, quota=100)
+        with pytest.raises(OSError):
+            NamedTemporaryFile(size=90)
+        fobj.close()
+        NamedTemporaryFile(size=90).close()
+
+    def test_quota_threads(self, dirs, monkeypatch):
+        # Slow down the creation so that the threads overlap
+        create = nx_tempfile._patch_encoding # pylint: disable=protected-access
+
+        def slow(*args, **kwargs):
+            time.sleep(0.05)
+            return create(*args, **kwargs)
+
+        monkeypatch.setattr(nx_tempfile, '_patch_encoding', slow)
+        set_placement(quota=100)
+        files = []
+        errors = []
+
+        def allocate():
+            try:
+                files.append(TemporaryFile(size=60))
+            except OSError as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=allocate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(files) == 1
+        assert len(errors) == 3
+        files[0].close()
+
+    def test_quota_failed_create(self, dirs):
+        set_placement(quota=100)
+        with pytest.raises(ValueError):
+            TemporaryFile('wb', errors='ignore', size=100)
+        # The reservation of the failed file has been released
+        TemporaryFile(size=100).close()
@@ -0,0 +1,134 @@
+# pylint: disable=missing-docstring, no-self-use, invalid-name
+import os
+import gc
+import random
+import pytest
+import nx_tempfile
+from nx_tempfile import (NamedTemporaryFile, TemporaryFile, track_files,
+                         live_files)
+
+
+@pytest.fixture
+def tracking():
+    yield
+    track_files(False)
+
+
+class TestRegistry:
+    def test_disabled(self):
+        track_files(False)
+        with TemporaryFile():
+            assert live_files() == []
+        assert nx_tempfile._registry is None # pylint: disable=protected-access
+
+    def test_live_files(self, tracking):
+        track_files()
+        first = TemporaryFile()
+        second = NamedTemporaryFile('w+t', encoding='ascii', errors='ignore')
+        files = {info.mode: info for info in live_files()}
+        assert sorted(files) == ['w+b', 'w+t']
+        assert not files['w+b'].closed and not files['w+t'].closed
+        assert files['w+t'].name == second.name
+        assert files['w+t'].delete is True
+        assert all(info.traceback is None for info in files.values())
+
+        second.close()
+        files = {info.mode: info for info in live_files()}
+        assert not files['w+b'].closed and files['w+t'].closed
+
+        del second
+        gc.collect()
+        assert len(live_files()) == 1
+        first.close()
+
+    def test_live_files_order(self, tracking):
+        track_files()
+        fobjs = [TemporaryFile() for _ in range(5)]
+        created = [info.created for info in live_files()]
+        assert created == sorted(created)
+        for fobj in fobjs:
+            fobj.close()
+
+    def test_sample(self, tracking):
+        track_files(sample=1.0)
+        with NamedTemporaryFile() as fobj:
+            stack = live_files()[0].traceback
+            assert 'test_sample' in stack[-1]
+            assert all(nx_tempfile.__file__ not in line for line in stack)
+        del fobj
+
+    def test_sample_rng(self, tracking):
+        random.seed(1)
+        expected = random.random()
+        random.seed(1)
+        track_files(sample=0.5)
+        TemporaryFile().close()
+        assert random.random() == expected
+
+    @pytest.mark.parametrize('factory, mode, kwargs', [
+        (TemporaryFile, 'w+b', {}),
+        (NamedTemporaryFile, 'w+b', {}),
+        (NamedTemporaryFile, 'w+t', {'errors': 'ignore'})])
+    def test_leak_in_cycle(self, tracking, factory, mode, kwargs):
+        class Holder:
+            def __init__(self, fobj):
+                self.fobj = fobj
+                self.cycle = self
+
+        track_files()
+        fds = []
+        for _ in range(6):
+            fobj = factory(mode, **kwargs)
+            fobj.write(b'data' if 'b' in mode else 'data')
+            fds.append(os.dup(fobj.fileno()))
+            Holder(fobj)
+        del fobj
+        with pytest.warns(ResourceWarning) as record:
+            gc.collect()
+        assert len([w for w in record
+                    if 'was never closed' in str(w.message)]) == 6
+        for fd in fds:
+            # The buffered data was written out when the file was closed
+            assert os.pread(fd, 10, 0) == b'data'
+            os.close(fd)
+
+    @pytest.mark.parametrize('kwargs', [{}, {'errors': 'ignore'}])
+    def test_leak_warning(self, tracking, kwargs):
+        track_files(sample=1.0)
+        fobj = NamedTemporaryFile('w+t', delete=False, **kwargs)
+        name = fobj.name
+        with pytest.warns(ResourceWarning) as record:
+            del fobj
+            gc.collect()
+        message = [str(w.message) for w in record
+                   if 'temporary file {} was'.format(name) in str(w.message)]
+        assert 'test_leak_warning' in message[0]
+        assert os.path.exists(name)
+        os.unlink(name)
+
+    @pytest.mark.parametrize('kwargs', [{}, {'errors': 'ignore'}])
+    def test_leak_cleanup(self, tracking, kwargs):
+        track_files(cleanup=True)
+        fobj = NamedTemporaryFile('w+t', delete=False, **kwargs)
+        name = fobj.name
+        with pytest.warns(ResourceWarning):
+            del fobj
+            gc.collect()
+        assert not os.path.exists(name)
+
+    @pytest.mark.parametrize('kwargs', [{}, {'errors': 'ignore'}])
+    def test_closed_kept(self, tracking, recwarn, kwargs):
+        track_files(cleanup=True)
+        fobj = NamedTemporaryFile('w+t', delete=False, **kwargs)
+        name = fobj.name
+        fobj.close()
+        del fobj
+        gc.collect()
+        with NamedTemporaryFile('w+t', delete=False, **kwargs) as fobj:
+            other = fobj.name
+        del fobj
+        gc.collect()
+        assert not [w for w in recwarn if w.category is ResourceWarning]
+        assert os.path.exists(name) and os.path.exists(other)
+        os.unlink(name)
+        os.unlink(other)